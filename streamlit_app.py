@@ -1,11 +1,21 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+import hashlib
+from collections import defaultdict
+from datetime import datetime
 import plotly.express as px
 import holidays
 import calendar
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # Set page config
 st.set_page_config(page_title="TimeCamp Employee Status", layout="wide")
 
@@ -44,89 +54,76 @@ st.markdown(
 )
 
 
-@st.cache_data(ttl=3600)
-def get_israeli_holidays(year):
-    il_holidays = holidays.IL(years=year)
-    return {
-        date.strftime("%Y-%m-%d"): name for date, name in il_holidays.items()
-    }
-
-
-def is_holiday_eve(date, il_holidays):
-    """Check if the given date is a holiday eve"""
-    next_day = date + timedelta(days=1)
-    next_day_str = next_day.strftime("%Y-%m-%d")
-    return next_day_str in il_holidays
-
-
-def get_required_hours(date, il_holidays):
-    """Determine required work hours based on day and holiday status"""
-    date_str = date.strftime("%Y-%m-%d")
-    weekday = date.weekday()
-
-    # Friday (4) and Saturday (5) - no work
-    if weekday in {4, 5}:
-        return 0
-
-    # Check if it's a holiday
-    if date_str in il_holidays:
-        return 0
-
-    # Check if it's a holiday eve
-    if is_holiday_eve(date, il_holidays):
-        return 7.5
-
-    # Thursday (3)
-    if weekday == 3:
-        return 8
-
-    # Sunday (6) to Wednesday (2)
-    return 8.5
+@st.cache_resource(show_spinner=False)
+def get_israeli_holidays(first_year, last_year):
+    """Holiday names for the years, indexed by a DatetimeIndex.
 
+    The calendar never changes, so a single shared instance is kept instead
+    of a serialized copy per call.
+    """
+    il_holidays = holidays.IL(years=range(first_year, last_year + 1))
+    return pd.Series(
+        list(il_holidays.values()),
+        index=pd.DatetimeIndex(list(il_holidays.keys())),
+    ).sort_index()
+
+
+def get_required_hours_range(dates, il_holidays):
+    """Required work hours for each date, by weekday and holiday status"""
+    days = dates.normalize()
+    weekday = days.weekday
+    is_holiday = days.isin(il_holidays.index)
+    is_eve = (days + pd.Timedelta(days=1)).isin(il_holidays.index)
+
+    # Friday (4) and Saturday (5) - no work, Thursday (3) - 8, otherwise 8.5
+    required = np.where(
+        np.isin(weekday, [4, 5]), 0.0, np.where(weekday == 3, 8.0, 8.5)
+    )
 
-def fetch_data(api_key, year, month):
-    first_day = datetime(year, month, 1)
+    # Holiday eves are shortened and holidays are off
+    required[is_eve & (required > 0)] = 7.5
+    required[is_holiday] = 0.0
+    return required
 
-    # Adjust the last day to today if it's the current month and year
-    if year == datetime.now().year and month == datetime.now().month:
-        last_day = datetime.now()
-    else:
-        last_day = (
-            first_day.replace(day=1, month=month % 12 + 1) - timedelta(days=1)
-            if month < 12
-            else datetime(year + 1, 1, 1) - timedelta(days=1)
-        )
 
-    date_range = [
-        first_day + timedelta(days=i)
-        for i in range((last_day - first_day).days + 1)
-    ]
+def get_month_range(year, month):
+    """First and last day of the given month"""
+    _, days_in_month = calendar.monthrange(year, month)
+    return (
+        datetime(year, month, 1).date(),
+        datetime(year, month, days_in_month).date(),
+    )
 
-    # Get Israeli holidays for the selected year
-    il_holidays = get_israeli_holidays(year)
 
-    results = []
+def fetch_data(api_key, first_day, last_day):
+    # Get Israeli holidays for every year the range spans
+    il_holidays = get_israeli_holidays(first_day.year, last_day.year)
 
-    for date in date_range:
-        # Check required hours for this date
-        required_hours = get_required_hours(date, il_holidays)
+    date_range = pd.date_range(first_day, last_day, freq="D")
 
-        # Only fetch data if work is required on this day
-        if required_hours > 0:
-            work_hours, tasks = get_work_hours_and_tasks(api_key, date)
-            results.append((date, work_hours, tasks, required_hours))
+    # Only fetch data for days where work is required
+    required_by_day = get_required_hours_range(date_range, il_holidays)
+    is_workday = required_by_day > 0
+    workdays = date_range[is_workday]
 
-    if results:
+    if not workdays.empty:
+        # One request for the whole range, then look up each workday locally
+        work_hours_by_date = get_work_hours_range(api_key, first_day, last_day)
+        results = [
+            work_hours_by_date.get(date, (0.0, [])) for date in workdays.date
+        ]
+        # One row per workday, in date order
         df = pd.DataFrame(
-            results, columns=["Date", "Hours", "Tasks", "Required Hours"]
-        )
-        df["Date"] = pd.to_datetime(df["Date"])
-        df["Day"] = df["Date"].dt.day_name()
-
-        # Apply running balance calculations
-        df = df.sort_values("Date")
-
-        # Calculate daily difference (actual - required)
+            {
+                "Hours": [work_hours for work_hours, _ in results],
+                "Tasks": [tasks for _, tasks in results],
+                "Required Hours": required_by_day[is_workday],
+            },
+            index=workdays,
+        ).reset_index(names="Date")
+
+        # Running balance calculations, starting from the daily difference
+        # (actual - required)
         df["Daily Difference"] = df["Hours"].fillna(0) - df["Required Hours"]
 
         # Calculate running balance and target
@@ -136,126 +133,171 @@ def fetch_data(api_key, year, month):
         ].cumsum()  # Negative because we start at 0 and accumulate required hours
 
         # Update status based on running balance
-        df["Status"] = df.apply(
-            lambda row: (
-                "OK"
-                if (
-                    pd.notnull(row["Hours"])
-                    and (
-                        (
-                            row["Running Balance"] >= row["Target Balance"]
-                            and row["Hours"] <= 11.5
-                        )
-                        or (
-                            row["Running Balance"] < row["Target Balance"]
-                            and row["Hours"] >= row["Required Hours"]
-                        )
-                    )
-                )
-                else "Warning"
-            ),
-            axis=1,
+        hours = df["Hours"].to_numpy(dtype=float)
+        required = df["Required Hours"].to_numpy()
+        balance = df["Running Balance"].to_numpy()
+        target = df["Target Balance"].to_numpy()
+        ok = ~np.isnan(hours) & (
+            ((balance >= target) & (hours <= 11.5))
+            | ((balance < target) & (hours >= required))
+        )
+        df["Status"] = pd.Categorical.from_codes(
+            (~ok).astype(np.int8), categories=["OK", "Warning"]
         )
 
         # Calculate missing hours only for the final day if running balance is below target
-        df["Missing Hours"] = 0  # Initialize all days to 0
-        final_gap = (
-            df["Running Balance"].iloc[-1] - df["Target Balance"].iloc[-1]
-        )
+        missing_hours = np.zeros(len(df))  # Initialize all days to 0
+        final_gap = balance[-1] - target[-1]
         if final_gap < 0:
-            df.loc[df.index[-1], "Missing Hours"] = abs(final_gap)
+            missing_hours[-1] = abs(final_gap)
+        df["Missing Hours"] = missing_hours
 
         return df, il_holidays
     return pd.DataFrame(), il_holidays
 
 
-def get_work_hours_and_tasks(api_key, date):
+@st.cache_resource
+def get_session():
+    """Shared HTTP session so connections to TimeCamp are reused"""
+    session = requests.Session()
+    retries = Retry(
+        total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(
+        pool_connections=16, pool_maxsize=16, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def hash_api_key(api_key):
+    # Bytes, not str, or Streamlit would pass the result back to this hasher
+    return hashlib.sha256(api_key.encode()).digest()
+
+
+# Past months never change, so they are kept on disk across restarts
+@st.cache_data(persist="disk", hash_funcs={str: hash_api_key})
+def fetch_historical(api_key, first_day, last_day):
+    return fetch_data(api_key, first_day, last_day)
+
+
+# The current month is still being logged, so revalidate it regularly
+@st.cache_data(ttl=600, hash_funcs={str: hash_api_key})
+def fetch_current_month(api_key, first_day, last_day):
+    return fetch_data(api_key, first_day, last_day)
+
+
+class TimeCampError(Exception):
+    """Raised when entries could not be fetched from TimeCamp"""
+
+
+def get_work_hours_range(api_key, start, end):
+    """Fetch all entries between start and end, bucketed by date.
+
+    Returns a dict mapping each date to (hours, tasks). Raises
+    TimeCampError if the request failed, so failures are never cached.
+    """
     url = "https://app.timecamp.com/third_party/api/entries"
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Accept": "application/json",
     }
     params = {
-        "from": date.strftime("%Y-%m-%d"),
-        "to": date.strftime("%Y-%m-%d"),
+        "from": start.strftime("%Y-%m-%d"),
+        "to": end.strftime("%Y-%m-%d"),
         "user_ids": "me",
     }
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code == 200:
-        entries = response.json()
-        total_seconds = sum(int(entry["duration"]) for entry in entries)
-        tasks = [entry["name"] for entry in entries if entry["name"]]
-        return total_seconds / 3600, tasks
-    else:
-        return None, []
-
-
-def calculate_running_balance(df):
-    """Calculate running balance of work hours"""
-    df = df.sort_values("Date")
-
-    # Calculate daily difference (actual - required)
-    df["Daily Difference"] = df["Hours"].fillna(0) - df["Required Hours"]
-
-    # Calculate running balance
-    df["Running Balance"] = df["Daily Difference"].cumsum()
-
-    # Update status based on running balance
-    df["Status"] = df.apply(
-        lambda row: (
-            "OK"
-            if (
-                pd.notnull(row["Hours"])
-                and (
-                    (row["Running Balance"] >= 0 and row["Hours"] <= 11.5)
-                    or (
-                        row["Running Balance"] < 0
-                        and row["Hours"] >= row["Required Hours"]
-                    )
-                )
-            )
-            else "Warning"
-        ),
-        axis=1,
+    try:
+        response = get_session().get(
+            url, headers=headers, params=params, timeout=10
+        )
+    except requests.RequestException as e:
+        raise TimeCampError(str(e)) from e
+    if response.status_code != 200:
+        raise TimeCampError(f"TimeCamp returned HTTP {response.status_code}")
+
+    entries = json_loads(response.content)
+    if not entries:
+        return {}
+
+    # Sum durations per day in one grouped reduction
+    date_strs = pd.Index([entry["date"] for entry in entries])
+    durations = np.fromiter(
+        (int(entry["duration"]) for entry in entries),
+        dtype=np.int64,
+        count=len(entries),
     )
-
-    # Recalculate missing hours considering running balance
-    df["Missing Hours"] = df.apply(
-        lambda row: (
-            abs(row["Running Balance"])
-            if row["Running Balance"] < 0 and row["Date"] == row["Date"].max()
-            else 0
-        ),
-        axis=1,
+    hours_by_date = (
+        pd.Series(durations, index=date_strs).groupby(level=0).sum() / 3600
     )
 
-    return df
+    tasks_by_date = defaultdict(list)
+    for entry in entries:
+        if entry["name"]:
+            tasks_by_date[entry["date"]].append(entry["name"])
+
+    # Parse each distinct day once
+    dates = pd.to_datetime(hours_by_date.index, format="%Y-%m-%d").date
+    return {
+        date: (hours, tasks_by_date[date_str])
+        for date_str, date, hours in zip(
+            hours_by_date.index, dates, hours_by_date.to_numpy()
+        )
+    }
 
 
 def display_holidays(il_holidays, year, month):
-    selected_month_holidays = {
-        date: name
-        for date, name in il_holidays.items()
-        if datetime.strptime(date, "%Y-%m-%d").month == month
-        and datetime.strptime(date, "%Y-%m-%d").year == year
-    }
+    month_label = f"{calendar.month_name[month]} {year}"
 
-    if selected_month_holidays:
-        st.subheader(f"Holidays in {calendar.month_name[month]} {year}")
-        st.markdown('<div class="holiday-list">', unsafe_allow_html=True)
-        for date, holiday_name in selected_month_holidays.items():
-            formatted_date = datetime.strptime(date, "%Y-%m-%d").strftime(
-                "%d %B"
-            )
-            st.markdown(
-                f'<div class="holiday-item">🗓 {formatted_date}: {holiday_name}</div>',
-                unsafe_allow_html=True,
-            )
-        st.markdown("</div>", unsafe_allow_html=True)
-    else:
-        st.info(
-            f"There are no holidays in {calendar.month_name[month]} {year}."
+    # Holidays are sorted by date, so the month is a binary-searched slice
+    month_start = pd.Timestamp(year, month, 1)
+    selected_month_holidays = il_holidays.loc[
+        month_start : month_start + pd.offsets.MonthEnd(0)
+    ]
+
+    if not selected_month_holidays.empty:
+        st.subheader(f"Holidays in {month_label}")
+        # One markdown call so the items render inside the list container
+        items = "".join(
+            f'<div class="holiday-item">🗓 {date.strftime("%d %B")}: {holiday_name}</div>'
+            for date, holiday_name in selected_month_holidays.items()
         )
+        st.markdown(
+            f'<div class="holiday-list">{items}</div>', unsafe_allow_html=True
+        )
+    else:
+        st.info(f"There are no holidays in {month_label}.")
+
+
+@st.fragment
+def render_chart(df):
+    """Build the hours chart only once the user asks for it"""
+    if not st.toggle("Show chart"):
+        return
+
+    # Hours bar chart
+    fig1 = px.bar(
+        df,
+        x="Date",
+        y="Hours",
+        color="Status",
+        hover_data=[
+            "Day",
+            "Required Hours",
+            "Running Balance",
+            "Tasks",
+        ],
+        labels={"Hours": "Work Hours"},
+        color_discrete_map={"OK": "green", "Warning": "red"},
+    )
+    fig1.add_scatter(
+        x=df["Date"],
+        y=df["Required Hours"],
+        mode="lines",
+        name="Required Hours",
+        line=dict(color="blue", dash="dash"),
+    )
+    st.plotly_chart(fig1, use_container_width=True)
 
 
 def main():
@@ -266,8 +308,9 @@ def main():
     api_key = st.sidebar.text_input("API Key:", type="password")
 
     # Year and Month selection
-    current_year = datetime.now().year
-    current_month = datetime.now().month
+    now = datetime.now()
+    current_year = now.year
+    current_month = now.month
     year = st.sidebar.selectbox(
         "Select Year", range(current_year - 2, current_year + 3), index=2
     )
@@ -286,6 +329,8 @@ def main():
         )
         end_date = st.sidebar.date_input("End date", datetime(year, month, 28))
 
+    month_label = f"{calendar.month_name[month]} {year}"
+
     fetch_button = st.sidebar.button("Fetch Data")
     if not fetch_button:
         st.markdown(
@@ -309,22 +354,58 @@ def main():
         if not api_key:
             st.sidebar.error("Please enter an API key.")
         else:
-            with st.spinner("Fetching data..."):
-                if use_custom_date:
-                    df, il_holidays = fetch_data(
-                        api_key, start_date.year, start_date.month
+            if use_custom_date:
+                first_day, last_day = start_date, end_date
+            else:
+                first_day, last_day = get_month_range(year, month)
+
+            # Don't count the rest of the current month; other months are
+            # shown in full, as before
+            if (last_day.year, last_day.month) == (
+                current_year,
+                current_month,
+            ):
+                last_day = min(last_day, now.date())
+
+            # Only ranges in months that are over are safe to keep indefinitely
+            historical = (last_day.year, last_day.month) < (
+                current_year,
+                current_month,
+            )
+            session_key = (
+                hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest(),
+                first_day,
+                last_day,
+            )
+
+            if historical and session_key in st.session_state:
+                df, il_holidays = st.session_state[session_key]
+            else:
+                fetch = fetch_historical if historical else fetch_current_month
+                try:
+                    with st.spinner("Fetching data..."):
+                        df, il_holidays = fetch(api_key, first_day, last_day)
+                except TimeCampError:
+                    st.error(
+                        "Failed to fetch data. Please check your API key and try again."
                     )
-                    df = df[
-                        (df["Date"].dt.date >= start_date)
-                        & (df["Date"].dt.date <= end_date)
-                    ]
-                else:
-                    df, il_holidays = fetch_data(api_key, year, month)
+                    return
+                if historical:
+                    st.session_state[session_key] = (df, il_holidays)
 
             # Display holidays for the selected month
             display_holidays(il_holidays, year, month)
 
             if not df.empty:
+                # Day names are only needed for display. assign returns a new
+                # frame, so a frame kept in session state is not modified
+                df = df.assign(
+                    Day=pd.Categorical.from_codes(
+                        df["Date"].dt.dayofweek,
+                        categories=list(calendar.day_name),
+                    )
+                )
+
                 # Summary statistics with running balance
                 total_hours = df["Hours"].sum()
                 final_balance = df["Running Balance"].iloc[-1]
@@ -355,15 +436,17 @@ def main():
                 # Display detailed table with running balance
                 st.subheader("Detailed Work Log")
 
-                def color_status(row):
-                    return [
-                        (
-                            "background-color: yellow"
-                            if row.Status == "Warning"
-                            else ""
-                        )
-                        for _ in row
-                    ]
+                def color_status(data):
+                    warning = data["Status"].eq("Warning").to_numpy()[:, None]
+                    return pd.DataFrame(
+                        np.where(
+                            np.broadcast_to(warning, data.shape),
+                            "background-color: yellow",
+                            "",
+                        ),
+                        index=data.index,
+                        columns=data.columns,
+                    )
 
                 display_columns = [
                     "Date",
@@ -376,62 +459,47 @@ def main():
                     "Tasks",
                 ]
 
-                styled_df = df[display_columns].style.apply(
-                    color_status, axis=1
-                )
+                # Format dates once for both the table and the links
+                date_strs = df["Date"].dt.strftime("%Y-%m-%d")
+
+                display_df = df[display_columns].copy()
+                display_df["Date"] = date_strs
 
                 # Add TimeCamp link
-                df["TimeCamp Link"] = df["Date"].apply(
-                    lambda x: f'<a href="https://app.timecamp.com/app#/timesheets/timer/{x.strftime("%Y-%m-%d")}" target="_blank"><button>View in TimeCamp</button></a>'
+                display_df["TimeCamp Link"] = (
+                    "https://app.timecamp.com/app#/timesheets/timer/"
+                    + date_strs
+                )
+                styled_df = display_df.style.apply(
+                    color_status, axis=None
+                ).format(
+                    {
+                        "Hours": "{:.2f}",
+                        "Required Hours": "{:.2f}",
+                        "Daily Difference": "{:.2f}",
+                        "Running Balance": "{:.2f}",
+                    }
                 )
 
-                st.write(
-                    styled_df.format(
-                        {
-                            "Date": lambda x: x.strftime("%Y-%m-%d"),
-                            "Hours": "{:.2f}",
-                            "Required Hours": "{:.2f}",
-                            "Daily Difference": "{:.2f}",
-                            "Running Balance": "{:.2f}",
-                        }
-                    ).to_html(escape=False),
-                    unsafe_allow_html=True,
+                st.dataframe(
+                    styled_df,
+                    column_config={
+                        "TimeCamp Link": st.column_config.LinkColumn(
+                            "TimeCamp", display_text="View in TimeCamp"
+                        )
+                    },
+                    hide_index=True,
+                    width="stretch",
                 )
 
                 # Visualizations
-                st.subheader(
-                    f"Daily Work Hours for {calendar.month_name[month]} {year}"
-                )
+                st.subheader(f"Daily Work Hours for {month_label}")
 
-                # Hours bar chart
-                fig1 = px.bar(
-                    df,
-                    x="Date",
-                    y="Hours",
-                    color="Status",
-                    hover_data=[
-                        "Day",
-                        "Required Hours",
-                        "Running Balance",
-                        "Tasks",
-                    ],
-                    labels={"Hours": "Work Hours"},
-                    color_discrete_map={"OK": "green", "Warning": "red"},
-                )
-                fig1.add_scatter(
-                    x=df["Date"],
-                    y=df["Required Hours"],
-                    mode="lines",
-                    name="Required Hours",
-                    line=dict(color="blue", dash="dash"),
-                )
-                st.plotly_chart(fig1, use_container_width=True)
+                render_chart(df)
 
 
             else:
-                st.error(
-                    "Failed to fetch data. Please check your API key and try again."
-                )
+                st.info("There are no workdays in the selected range.")
 
 
 if __name__ == "__main__":